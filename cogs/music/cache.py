@@ -0,0 +1,40 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """A small LRU cache whose entries expire `ttl` seconds after being set."""
+
+    def __init__(self, ttl: float, maxsize: int = 256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            expires_at, value = self._data[key]
+        except KeyError:
+            return default
+
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
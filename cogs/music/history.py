@@ -0,0 +1,106 @@
+import bisect
+
+from .ranking import normalize
+from .store import JSONStore
+
+# Writes are batched; a burst of plays turns into a single save.
+FLUSH_DELAY = 30
+
+
+class PlayHistory:
+    """Resolved plays per guild, with an in-memory prefix index for autocomplete.
+
+    Lookups never touch the network or the disk, so they fit comfortably in
+    Discord's autocomplete budget.
+    """
+
+    def __init__(self, store: JSONStore = None):
+        self.store = store or JSONStore('history.json')
+
+        data = self.store.load(default={})
+        self.videos = data.get('videos', {})
+        self.plays = {int(guild_id): counts for guild_id, counts in data.get('plays', {}).items()}
+
+        self._index = {}
+        self._tokens = []
+        for video_id, video in self.videos.items():
+            self._index_video(video_id, video)
+
+    @staticmethod
+    def _video_tokens(video: dict) -> set:
+        return set(normalize(f"{video['title']} {video['uploader']}").split())
+
+    def _index_video(self, video_id: str, video: dict):
+        for token in self._video_tokens(video):
+            if token not in self._index:
+                self._index[token] = set()
+                bisect.insort(self._tokens, token)
+            self._index[token].add(video_id)
+
+    def _unindex_video(self, video_id: str, video: dict):
+        for token in self._video_tokens(video):
+            video_ids = self._index.get(token)
+            if video_ids is None:
+                continue
+
+            video_ids.discard(video_id)
+            if not video_ids:
+                del self._index[token]
+                del self._tokens[bisect.bisect_left(self._tokens, token)]
+
+    def _prefixed(self, prefix: str) -> set:
+        found = set()
+        start = bisect.bisect_left(self._tokens, prefix)
+        for token in self._tokens[start:]:
+            if not token.startswith(prefix):
+                break
+            found |= self._index[token]
+        return found
+
+    def record(self, guild_id: int, info: dict):
+        """Remembers a resolved play.
+
+        Only YouTube extractions are kept, since suggestions resolve back to a
+        YouTube watch URL by id.
+        """
+        video_id = info.get('id')
+        if info.get('extractor_key') != 'Youtube' or not video_id or not info.get('title'):
+            return
+
+        video = {'title': info['title'], 'uploader': info.get('uploader') or ''}
+        previous = self.videos.get(video_id)
+        if previous != video:
+            if previous:
+                self._unindex_video(video_id, previous)
+            self.videos[video_id] = video
+            self._index_video(video_id, video)
+
+        counts = self.plays.setdefault(guild_id, {})
+        counts[video_id] = counts.get(video_id, 0) + 1
+
+        self.store.save_later(self._dump, FLUSH_DELAY)
+
+    def suggest(self, guild_id: int, query: str, limit: int = 25) -> list:
+        """Returns `(video_id, video)` pairs the guild played that match `query`.
+
+        Every word of the query must prefix a word of the title or uploader.
+        Results are ordered by how often the guild played them.
+        """
+        counts = self.plays.get(guild_id)
+        if not counts:
+            return []
+
+        candidates = set(counts)
+        for token in normalize(query).split():
+            candidates &= self._prefixed(token)
+            if not candidates:
+                return []
+
+        ranked = sorted(candidates, key=counts.__getitem__, reverse=True)[:limit]
+        return [(video_id, self.videos[video_id]) for video_id in ranked]
+
+    def _dump(self) -> dict:
+        return {'videos': dict(self.videos), 'plays': {str(k): dict(v) for k, v in self.plays.items()}}
+
+    async def flush(self):
+        await self.store.save_async(self._dump())
@@ -0,0 +1,110 @@
+import asyncio
+import json
+
+from .store import JSONStore
+
+# Integrated loudness every track is brought to, in LUFS.
+TARGET_LUFS = -14.0
+# Boosts are capped lower than cuts; PCMVolumeTransformer clips rather than limits.
+MAX_BOOST_DB = 6.0
+MAX_CUT_DB = 12.0
+
+ANALYSIS_CONCURRENCY = 1
+ANALYSIS_TIMEOUT = 15 * 60
+FLUSH_DELAY = 30
+
+
+def parse_loudnorm_output(output: str):
+    """Pulls `input_i` out of the JSON block loudnorm prints on its first pass."""
+    start = output.rfind('{')
+    end = output.rfind('}')
+    if start == -1 or end < start:
+        return None
+
+    try:
+        measured = float(json.loads(output[start:end + 1])['input_i'])
+    except (ValueError, KeyError):
+        return None
+
+    # Silence measures as -inf; there's nothing sensible to normalize.
+    if measured != measured or measured in (float('inf'), float('-inf')):
+        return None
+
+    return measured
+
+
+class LoudnessCache:
+    """Integrated loudness per video id, measured once in the background.
+
+    `gain` is a dict lookup, so playback never waits on analysis; tracks
+    play at unity gain until their measurement lands.
+    """
+
+    def __init__(self, store: JSONStore = None):
+        self.store = store or JSONStore('loudness.json')
+        self.measurements = self.store.load(default={})
+
+        self._pending = set()
+        self._semaphore = asyncio.Semaphore(ANALYSIS_CONCURRENCY)
+
+    def gain(self, video_id: str) -> float:
+        """Linear gain that brings `video_id` to TARGET_LUFS, or 1.0 if unmeasured."""
+        measured = self.measurements.get(video_id)
+        if measured is None:
+            return 1.0
+
+        gain_db = max(-MAX_CUT_DB, min(MAX_BOOST_DB, TARGET_LUFS - measured))
+        return 10 ** (gain_db / 20)
+
+    def analyse(self, video_id: str, stream_url: str):
+        """Schedules a measurement unless one is cached or already running."""
+        if not video_id or not stream_url:
+            return
+        if video_id in self.measurements or video_id in self._pending:
+            return
+
+        self._pending.add(video_id)
+        asyncio.get_event_loop().create_task(self._analyse(video_id, stream_url))
+
+    async def _analyse(self, video_id: str, stream_url: str):
+        try:
+            async with self._semaphore:
+                measured = await self.measure(stream_url)
+        finally:
+            self._pending.discard(video_id)
+
+        if measured is not None:
+            self.measurements[video_id] = measured
+            self.store.save_later(lambda: dict(self.measurements), FLUSH_DELAY)
+
+    @staticmethod
+    async def measure(stream_url: str):
+        command = [
+            'ffmpeg', '-hide_banner', '-nostdin', '-nostats',
+            '-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5',
+            '-i', stream_url, '-vn',
+            '-af', f'loudnorm=I={TARGET_LUFS}:print_format=json',
+            '-f', 'null', '-',
+        ]
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        except OSError as e:
+            print(f"Error starting loudness analysis: {e}")
+            return None
+
+        try:
+            async with asyncio.timeout(ANALYSIS_TIMEOUT):
+                _, stderr = await process.communicate()
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            return None
+
+        if process.returncode != 0:
+            return None
+
+        return parse_loudnorm_output(stderr.decode('utf-8', errors='replace'))
+
+    async def flush(self):
+        await self.store.save_async(dict(self.measurements))
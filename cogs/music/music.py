@@ -6,16 +6,33 @@ import aiohttp
 import traceback
 import subprocess
 import json
+import time
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
 
 from .ytdl import YTDLError, YTDLSource, FFMPEG_OPTIONS
 from .queue import SongQueue
+from .history import PlayHistory
+from .loudness import LoudnessCache
+from .snapshot import QueueSnapshots, capture_state
+from .cache import TTLCache
 
 from typing import Optional
 
+SNAPSHOT_INTERVAL = 30
+# Stream URLs expiring within REFRESH_MARGIN seconds are re-resolved ahead of time.
+REFRESH_INTERVAL = 60
+REFRESH_MARGIN = 15 * 60
+REFRESH_CONCURRENCY = 2
+# Videos that fail to refresh aren't retried for this long; the player's
+# last-resort refresh still covers them if they come up meanwhile.
+REFRESH_BACKOFF = 30 * 60
+# Restores after a restart are spread out so they don't all extract at once.
+RESTORE_CONCURRENCY = 2
+RESTORE_STAGGER = 5
+
 class Song:
     __slots__ = ('source', 'requester')
 
@@ -23,6 +40,34 @@ class Song:
         self.source = source
         self.requester = source.requester
 
+    @property
+    def title(self):
+        return self.source.title
+
+    @property
+    def url(self):
+        return self.source.url
+
+    def snapshot(self, position: float = None):
+        """Compact form for queue snapshots, or None if the song can't be resolved again by URL.
+
+        Direct audio URLs have no page URL and are left out.
+        """
+        webpage_url = self.source.data.get('webpage_url')
+        if not webpage_url or self.source.channel is None:
+            return None
+
+        entry = {
+            'url': webpage_url,
+            'title': self.source.title,
+            'requester': self.requester.id,
+            'channel': self.source.channel.id,
+        }
+        if position:
+            entry['position'] = round(position, 1)
+
+        return entry
+
     def create_embed(self):
         embed = (discord.Embed(title='Now playing',
                                description='```css\n{0.source.title}\n```'.format(self),
@@ -35,10 +80,39 @@ class Song:
 
         return embed
 
+class PendingSong:
+    """A restored queue entry, only resolved once the player gets to it."""
+    __slots__ = ('guild', 'entry')
+
+    def __init__(self, guild: discord.Guild, entry: dict):
+        self.guild = guild
+        self.entry = entry
+
+    @property
+    def title(self):
+        return self.entry.get('title') or self.entry['url']
+
+    @property
+    def url(self):
+        return self.entry['url']
+
+    def snapshot(self, position: float = None):
+        return self.entry
+
+    async def resolve(self, bot: commands.Bot) -> Song:
+        ctx = await restored_context(bot, self.guild, self.entry)
+        if ctx is None:
+            raise YTDLError('No text channel left to announce `{}` in'.format(self.title))
+
+        source = await YTDLSource.create_source_from_url(ctx, self.url, loop=bot.loop,
+                                                         start=self.entry.get('position', 0))
+        return Song(source)
+
 class VoiceState:
-    def __init__(self, bot: commands.Bot, ctx: commands.Context):
+    def __init__(self, bot: commands.Bot, ctx: commands.Context, loudness: LoudnessCache = None):
         self.bot = bot
         self._ctx = ctx
+        self.loudness = loudness
 
         self.current = None
         self.voice = None
@@ -47,6 +121,8 @@ class VoiceState:
 
         self._loop = False
         self._volume = 0.5
+        self._started_at = None
+        self._paused_at = None
         self.skip_votes = set()
 
         self.audio_player = bot.loop.create_task(self.audio_player_task())
@@ -74,11 +150,30 @@ class VoiceState:
     def is_playing(self):
         return self.voice and self.current
 
+    @property
+    def position(self):
+        """Approximate playback position of the current song, in seconds."""
+        if not self.current or self._started_at is None:
+            return 0
+
+        now = self._paused_at or time.monotonic()
+        return self.current.source.start + now - self._started_at
+
+    def pause(self):
+        self.voice.pause()
+        self._paused_at = time.monotonic()
+
+    def resume(self):
+        self.voice.resume()
+        if self._paused_at is not None and self._started_at is not None:
+            self._started_at += time.monotonic() - self._paused_at
+        self._paused_at = None
+
     async def audio_player_task(self):
         while True:
             self.next.clear()
 
-            if not self.loop:
+            if not self.loop or not self.current:
                 # Try to get the next song within 3 minutes.
                 # If no song will be added to the queue in time,
                 # the player will disconnect due to performance
@@ -90,16 +185,58 @@ class VoiceState:
                     self.bot.loop.create_task(self.stop())
                     return
 
-            self.current.source.volume = self._volume
+                if isinstance(self.current, PendingSong):
+                    try:
+                        self.current = await self.current.resolve(self.bot)
+                    except YTDLError as e:
+                        print(f"Error restoring {self.current.url}: {e}")
+                        self.current = None
+                        continue
+            else:
+                # The previous run used up its ffmpeg process.
+                self.current.source.rewind()
+
+            # Last resort if the background refresh didn't get to this one in time.
+            if self.current.source.expires_within(0):
+                try:
+                    await self.current.source.refresh(loop=self.bot.loop)
+                except YTDLError as e:
+                    print(f"Error refreshing expired stream for {self.current.source.title}: {e}")
+                    await self.current.source.channel.send('Skipping **{}**, it is no longer available.'.format(self.current.source.title))
+                    self.current = None
+                    continue
+
+            # No-op once measured; covers songs that never went through _play (e.g. restored ones).
+            if self.loudness:
+                self.loudness.analyse(self.current.source.data.get('id'), self.current.source.stream_url)
+
+            self.current.source.volume = self._volume * self.track_gain(self.current)
             self.voice.play(self.current.source, after=self.play_next_song)
+            self._started_at = time.monotonic()
             await self.current.source.channel.send(embed=self.current.create_embed())
 
             await self.next.wait()
 
+    def track_gain(self, song: Song) -> float:
+        if not self.loudness:
+            return 1.0
+
+        return self.loudness.gain(song.source.data.get('id'))
+
     def play_next_song(self, error=None):
+        # Called from discord.py's audio thread; player state is only touched on the event loop.
+        self.bot.loop.call_soon_threadsafe(self.song_finished)
+
         if error:
             raise VoiceError(str(error))
 
+    def song_finished(self):
+        # Only a song that's in progress (or looping) counts as current.
+        if not self.loop:
+            self.current = None
+        self._started_at = None
+        self._paused_at = None
+
         self.next.set()
 
     def skip(self):
@@ -118,24 +255,229 @@ class VoiceState:
 class MusicContext(commands.Context):
     voice_state: Optional[VoiceState]
 
+class RestoredContext:
+    """Stands in for a command context when rebuilding a player after a restart."""
+
+    def __init__(self, bot: commands.Bot, guild: discord.Guild, author: discord.abc.User, channel: discord.abc.Messageable):
+        self.bot = bot
+        self.guild = guild
+        self.author = author
+        self.channel = channel
+
+async def restored_context(bot: commands.Bot, guild: discord.Guild, entry: dict) -> Optional[RestoredContext]:
+    """Rebuilds the requester and channel of a snapshot entry, or None if there's nowhere to post."""
+    author = guild.get_member(entry['requester'])
+    if author is None:
+        try:
+            author = await guild.fetch_member(entry['requester'])
+        except discord.HTTPException:
+            author = guild.me
+
+    candidates = [guild.get_channel(entry['channel']), guild.system_channel, *guild.text_channels]
+    channel = next((channel for channel in candidates
+                    if isinstance(channel, discord.TextChannel) and channel.permissions_for(guild.me).send_messages), None)
+    if channel is None:
+        return None
+
+    return RestoredContext(bot, guild, author, channel)
+
 class Music(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.voice_states = {}
-        
+        self.history = PlayHistory()
+        self.loudness = LoudnessCache()
+        self.snapshots = QueueSnapshots()
+        self._restoring = {}
+        self._restore_tasks = {}
+        self._restore_wakeups = {}
+        self._refresh_failures = TTLCache(ttl=REFRESH_BACKOFF, maxsize=1024)
 
     def get_voice_state(self, ctx: MusicContext):
         state = self.voice_states.get(ctx.guild.id)
         if not state:
-            state = VoiceState(self.bot, ctx)
+            if ctx.guild.id in self._restoring:
+                raise commands.CommandError('The player is still being restored, try again in a moment.')
+
+            state = VoiceState(self.bot, ctx, loudness=self.loudness)
             self.voice_states[ctx.guild.id] = state
 
         return state
 
+    async def cog_load(self):
+        self._restoring = {guild_id: snapshot for guild_id, snapshot in self.snapshots.load().items()
+                           if snapshot.get('current') and snapshot['current'].get('url')}
+        self.restore_voice_states()
+        self.save_snapshots.start()
+        self.refresh_streams.start()
+
     def cog_unload(self):
+        self.save_snapshots.cancel()
+        self.refresh_streams.cancel()
+
         for state in self.voice_states.values():
             self.bot.loop.create_task(state.stop())
 
+        self.bot.loop.create_task(self.history.flush())
+        self.bot.loop.create_task(self.loudness.flush())
+
+    @tasks.loop(seconds=SNAPSHOT_INTERVAL)
+    async def save_snapshots(self):
+        snapshots = {}
+        for guild_id, state in list(self.voice_states.items()):
+            if guild_id in self._restoring:
+                continue
+
+            try:
+                snapshot = capture_state(state)
+            except Exception as e:
+                print(f"Error capturing snapshot for guild {guild_id}: {type(e).__name__}: {e}")
+                continue
+
+            if snapshot:
+                snapshots[guild_id] = snapshot
+
+        # Guilds still being restored keep their previous snapshot until they're done.
+        snapshots.update(self._restoring)
+
+        try:
+            await self.snapshots.save(snapshots)
+        except Exception as e:
+            print(f"Error saving snapshots: {type(e).__name__}: {e}")
+
+    @tasks.loop(seconds=REFRESH_INTERVAL)
+    async def refresh_streams(self):
+        """Re-resolves stream URLs of queued and looping songs shortly before they expire.
+
+        Sources are grouped by page URL across guilds, so each video is extracted once
+        per round no matter how many queues hold it.
+        """
+        due = {}
+        for guild_id, state in list(self.voice_states.items()):
+            try:
+                songs = list(state.songs)
+                if state.loop and isinstance(state.current, Song):
+                    songs.append(state.current)
+
+                for song in songs:
+                    # Placeholders from a restore have no stream URL yet.
+                    if isinstance(song, PendingSong):
+                        continue
+
+                    webpage_url = song.source.url
+                    if not webpage_url or webpage_url in self._refresh_failures:
+                        continue
+
+                    if song.source.expires_within(REFRESH_MARGIN):
+                        due.setdefault(webpage_url, []).append(song.source)
+            except Exception as e:
+                print(f"Error collecting streams to refresh for guild {guild_id}: {type(e).__name__}: {e}")
+
+        if not due:
+            return
+
+        semaphore = asyncio.Semaphore(REFRESH_CONCURRENCY)
+
+        async def refresh(webpage_url, sources):
+            async with semaphore:
+                try:
+                    info = await YTDLSource.extract_full(webpage_url, loop=self.bot.loop)
+                    stream_url = info['url']
+                except (YTDLError, KeyError) as e:
+                    print(f"Error refreshing stream for {webpage_url}: {e}")
+                    self._refresh_failures.set(webpage_url, True)
+                    return
+
+            # Checked after the extraction: a queued song may have started meanwhile.
+            playing = {state.current.source for state in self.voice_states.values()
+                       if isinstance(state.current, Song)}
+            for source in sources:
+                try:
+                    # A song that's on air keeps its process; a looping one uses the new URL on rewind.
+                    source.set_stream_url(stream_url, reload=source not in playing)
+                except Exception as e:
+                    print(f"Error swapping stream for {webpage_url}: {type(e).__name__}: {e}")
+
+        results = await asyncio.gather(*(refresh(webpage_url, sources) for webpage_url, sources in due.items()),
+                                       return_exceptions=True)
+        for webpage_url, result in zip(due, results):
+            if isinstance(result, Exception):
+                print(f"Error refreshing stream for {webpage_url}: {type(result).__name__}: {result}")
+
+    def restore_voice_states(self):
+        """Schedules a restore for every player that was playing when the bot last stopped."""
+        semaphore = asyncio.Semaphore(RESTORE_CONCURRENCY)
+        for i, (guild_id, snapshot) in enumerate(list(self._restoring.items())):
+            self._restore_wakeups[guild_id] = asyncio.Event()
+            self._restore_tasks[guild_id] = self.bot.loop.create_task(
+                self.restore_voice_state(guild_id, snapshot, semaphore, delay=i * RESTORE_STAGGER))
+
+    async def wait_for_restore(self, guild_id: int):
+        """Brings a guild's pending restore forward and waits for it, e.g. when someone runs a command there."""
+        task = self._restore_tasks.get(guild_id)
+        if task is None:
+            return
+
+        self._restore_wakeups[guild_id].set()
+        await asyncio.shield(task)
+
+    async def restore_voice_state(self, guild_id: int, snapshot: dict, semaphore: asyncio.Semaphore, *, delay: float = 0):
+        try:
+            await self.bot.wait_until_ready()
+
+            # Restores are staggered, unless a command in the guild needs it sooner.
+            try:
+                async with asyncio.timeout(delay):
+                    await self._restore_wakeups[guild_id].wait()
+            except asyncio.TimeoutError:
+                pass
+
+            guild = self.bot.get_guild(guild_id)
+            voice_channel = guild and guild.get_channel(snapshot['voice_channel'])
+            if not voice_channel:
+                return
+
+            # Only the song that was playing is resolved now; the queue stays as
+            # placeholders that the player resolves one by one as it reaches them.
+            current = None
+            async with semaphore:
+                try:
+                    current = await PendingSong(guild, snapshot['current']).resolve(self.bot)
+                except YTDLError as e:
+                    print(f"Error restoring {snapshot['current']['url']} in guild {guild_id}: {e}")
+
+            songs = [PendingSong(guild, entry) for entry in snapshot['queue'] if entry.get('url')]
+            if current:
+                songs.insert(0, current)
+
+            # Never replace a player that came up in the meantime; queue the restored songs behind it.
+            state = self.voice_states.get(guild_id)
+            if state is not None:
+                for song in songs:
+                    await state.songs.put(song)
+                return
+
+            if guild.voice_client:
+                await guild.voice_client.move_to(voice_channel)
+                voice = guild.voice_client
+            else:
+                voice = await voice_channel.connect()
+
+            state = VoiceState(self.bot, RestoredContext(self.bot, guild, guild.me, None), loudness=self.loudness)
+            state.volume = snapshot.get('volume', state.volume)
+            state.voice = voice
+            self.voice_states[guild_id] = state
+
+            for song in songs:
+                await state.songs.put(song)
+            state.loop = bool(current) and snapshot.get('loop', False)
+        except Exception as e:
+            print(f"Error restoring voice state for guild {guild_id}: {type(e).__name__}: {e}")
+        finally:
+            self._restoring.pop(guild_id, None)
+            self._restore_tasks.pop(guild_id, None)
+            self._restore_wakeups.pop(guild_id, None)
+
     def cog_check(self, ctx: MusicContext):
         if not ctx.guild:
             raise commands.NoPrivateMessage('This command can\'t be used in DM channels.')
@@ -143,6 +485,7 @@ class Music(commands.Cog):
         return True
 
     async def cog_before_invoke(self, ctx: MusicContext):
+        await self.wait_for_restore(ctx.guild.id)
         ctx.voice_state = self.get_voice_state(ctx)
 
     async def cog_command_error(self, ctx: MusicContext, error: commands.CommandError):
@@ -232,6 +575,9 @@ class Music(commands.Cog):
     async def _now(self, ctx: MusicContext):
         """Displays the currently playing song."""
 
+        if not ctx.voice_state.current:
+            return await ctx.send('Nothing being played at the moment.')
+
         await ctx.send(embed=ctx.voice_state.current.create_embed())
 
     @commands.hybrid_command(name='pause')
@@ -239,8 +585,8 @@ class Music(commands.Cog):
     async def _pause(self, ctx: MusicContext):
         """Pauses the currently playing song."""
 
-        if not ctx.voice_state.is_playing and ctx.voice_state.voice.is_playing():
-            ctx.voice_state.voice.pause()
+        if ctx.voice_state.is_playing and ctx.voice_state.voice.is_playing():
+            ctx.voice_state.pause()
             await ctx.message.add_reaction('⏯')
 
     @commands.hybrid_command(name='resume')
@@ -248,8 +594,8 @@ class Music(commands.Cog):
     async def _resume(self, ctx: MusicContext):
         """Resumes a currently paused song."""
 
-        if not ctx.voice_state.is_playing and ctx.voice_state.voice.is_paused():
-            ctx.voice_state.voice.resume()
+        if ctx.voice_state.is_playing and ctx.voice_state.voice.is_paused():
+            ctx.voice_state.resume()
             await ctx.message.add_reaction('⏯')
 
     @commands.hybrid_command(name='stop')
@@ -308,7 +654,7 @@ class Music(commands.Cog):
 
         queue = ''
         for i, song in enumerate(ctx.voice_state.songs[start:end], start=start):
-            queue += '`{0}.` [**{1.source.title}**]({1.source.url})\n'.format(i + 1, song)
+            queue += '`{0}.` [**{1.title}**]({1.url})\n'.format(i + 1, song)
 
         embed = (discord.Embed(description='**{} tracks:**\n\n{}'.format(len(ctx.voice_state.songs), queue))
                  .set_footer(text='Viewing page {}/{}'.format(page, pages)))
@@ -405,7 +751,10 @@ class Music(commands.Cog):
 
         async with ctx.typing():
             try:
-                if 'spotify.com' in search:
+                video_id = YTDLSource.parse_video_id(search)
+                if video_id:
+                    source = await YTDLSource.create_source_from_id(ctx, video_id, loop=self.bot.loop)
+                elif 'spotify.com' in search:
                     source = await YTDLSource.handle_spotify_url(ctx, search)
                 elif await self.is_audio_url(search):
                     source = await self.create_audio_source(ctx, search)
@@ -416,8 +765,22 @@ class Music(commands.Cog):
             else:
                 song = Song(source)
                 await ctx.voice_state.songs.put(song)
+                self.history.record(ctx.guild.id, source.data)
+                self.loudness.analyse(source.data.get('id'), source.stream_url)
                 await ctx.send('Enqueued {}'.format(str(source)))
 
+    @_play.autocomplete('search')
+    async def play_autocomplete(self, interaction: discord.Interaction, current: str):
+        """Suggests songs this guild has played before, straight from the local history."""
+        if not interaction.guild_id:
+            return []
+
+        return [
+            app_commands.Choice(name='{} - {}'.format(video['title'], video['uploader'])[:100],
+                                value=YTDLSource.video_url(video_id))
+            for video_id, video in self.history.suggest(interaction.guild_id, current)
+        ]
+
     @_join.before_invoke
     @_play.before_invoke
     async def ensure_voice_state(self, ctx: MusicContext):
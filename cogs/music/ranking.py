@@ -0,0 +1,109 @@
+import re
+
+# Compiled once; scoring runs for every candidate of every track.
+_PUNCTUATION = re.compile(r'[^\w\s]')
+_WHITESPACE = re.compile(r'\s+')
+_NOISE = re.compile(r'\b(official|video|audio|lyrics?|hd|hq|4k|mv|visuali[sz]er)\b')
+
+# Duration deltas (in seconds) up to this are treated as the same recording.
+DURATION_TOLERANCE = 3
+# Beyond this a candidate is almost certainly an extended cut, live take or compilation.
+DURATION_CUTOFF = 60
+
+
+def normalize(text: str) -> str:
+    text = _PUNCTUATION.sub(' ', (text or '').lower())
+    return _WHITESPACE.sub(' ', text).strip()
+
+
+def tokenize(text: str) -> frozenset:
+    return frozenset(_NOISE.sub(' ', normalize(text)).split())
+
+
+def token_set_similarity(wanted: frozenset, found: frozenset) -> float:
+    """Scores how well `found` covers `wanted`, from 0.0 to 1.0.
+
+    Coverage dominates so extra words on YouTube titles ("feat. ...",
+    "(Remastered)") cost little, while the Jaccard term breaks ties in
+    favour of tighter titles.
+    """
+    if not wanted or not found:
+        return 0.0
+
+    common = len(wanted & found)
+    coverage = common / len(wanted)
+    jaccard = common / len(wanted | found)
+    return 0.75 * coverage + 0.25 * jaccard
+
+
+class TrackQuery:
+    """Precomputed, normalized view of a Spotify track used to score candidates."""
+
+    __slots__ = ('title', 'title_tokens', 'artist_tokens', 'duration', 'is_remix', 'is_live')
+
+    def __init__(self, title: str, artist: str = '', duration: float = None):
+        self.title = normalize(title)
+        self.title_tokens = tokenize(title)
+        self.artist_tokens = tokenize(artist)
+        self.duration = duration or None
+        self.is_remix = 'remix' in self.title
+        self.is_live = 'live' in self.title_tokens
+
+    @classmethod
+    def from_spotify(cls, spotify_info: dict):
+        return cls(spotify_info.get('title', ''), spotify_info.get('artist', ''), spotify_info.get('duration'))
+
+
+def score_candidate(query: TrackQuery, entry: dict) -> float:
+    """Calculates a matching score between a (possibly flat) YouTube entry and a track."""
+    title = normalize(entry.get('title'))
+    channel = normalize(entry.get('channel') or entry.get('uploader'))
+    title_tokens = tokenize(title)
+
+    score = 10 * token_set_similarity(query.title_tokens, title_tokens)
+    score += 5 * token_set_similarity(query.artist_tokens, title_tokens | tokenize(channel))
+
+    # Prefer official content
+    if channel.endswith(' topic'):
+        score += 3
+    if 'official' in title:
+        score += 2
+
+    # Penalize likely wrong matches
+    if 'cover' in title_tokens:
+        score -= 5
+    if 'remix' in title and not query.is_remix:
+        score -= 3
+    if 'live' in title_tokens and not query.is_live:
+        score -= 2
+
+    duration = entry.get('duration')
+    if query.duration and duration:
+        delta = abs(query.duration - duration)
+        if delta <= DURATION_TOLERANCE:
+            score += 4
+        else:
+            score -= 10 * min(delta, DURATION_CUTOFF) / DURATION_CUTOFF
+
+    return score
+
+
+def rank_candidates(query: TrackQuery, entries) -> list:
+    """Returns `(score, entry)` pairs, best first. Empty entries are skipped."""
+    scored = [(score_candidate(query, entry), entry) for entry in entries if entry]
+    scored.sort(key=lambda pair: pair[0], reverse=True)
+    return scored
+
+
+def best_match(query: TrackQuery, entries):
+    ranked = rank_candidates(query, entries)
+    return ranked[0][1] if ranked else None
+
+
+def best_matches(batch) -> list:
+    """Scores many tracks at once.
+
+    `batch` is an iterable of `(spotify_info, entries)` pairs; the result holds
+    the best entry (or None) for each pair, in order.
+    """
+    return [best_match(TrackQuery.from_spotify(info), entries) for info, entries in batch]
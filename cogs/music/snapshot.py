@@ -0,0 +1,43 @@
+from .store import JSONStore
+
+
+def capture_state(state):
+    """Snapshot of a single guild's player.
+
+    `current` is only set while a song is in progress, so idle players
+    aren't brought back after a restart.
+    """
+    if not state.voice:
+        return None
+
+    current = None
+    if state.current:
+        current = state.current.snapshot(state.position)
+
+    return {
+        'voice_channel': state.voice.channel.id,
+        'loop': state.loop,
+        'volume': state.volume,
+        'current': current,
+        'queue': [entry for entry in (song.snapshot() for song in state.songs) if entry],
+    }
+
+
+class QueueSnapshots:
+    """Per-guild player snapshots kept on disk so a restart can pick up where it left off."""
+
+    def __init__(self, store: JSONStore = None):
+        self.store = store or JSONStore('queues.json')
+        self._last = None
+
+    def load(self) -> dict:
+        return {int(guild_id): snapshot for guild_id, snapshot in self.store.load(default={}).items()}
+
+    async def save(self, snapshots: dict):
+        """Writes `snapshots` unless nothing changed since the last save."""
+        data = {str(guild_id): snapshot for guild_id, snapshot in snapshots.items()}
+        if data == self._last:
+            return
+
+        await self.store.save_async(data)
+        self._last = data
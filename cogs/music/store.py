@@ -0,0 +1,51 @@
+import asyncio
+import json
+import os
+
+DATA_DIR = os.getenv('BOT_DATA_DIR', 'data')
+
+
+class JSONStore:
+    """A JSON document on local disk, replaced atomically on every save."""
+
+    def __init__(self, name: str):
+        self.path = os.path.join(DATA_DIR, name)
+        self._save_task = None
+        self._dirty = False
+
+    def load(self, default=None):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return default
+        except (OSError, ValueError) as e:
+            print(f"Error loading {self.path}: {e}")
+            return default
+
+    def save(self, data):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    async def save_async(self, data):
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self.save, data)
+        except OSError as e:
+            print(f"Error saving {self.path}: {e}")
+
+    def save_later(self, get_data, delay: float):
+        """Saves `get_data()` after `delay` seconds, batching any calls made meanwhile."""
+        self._dirty = True
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.get_event_loop().create_task(self._save_after(get_data, delay))
+
+    async def _save_after(self, get_data, delay: float):
+        # Changes that land while a write is in flight go out in another round.
+        while self._dirty:
+            await asyncio.sleep(delay)
+            self._dirty = False
+            await self.save_async(get_data())
@@ -1,13 +1,19 @@
 import asyncio
+import codecs
 import functools
 import re
+import time
 from html.parser import HTMLParser
+from urllib.parse import parse_qs, urlsplit, urlunsplit
 
 import aiohttp
 import discord
 import yt_dlp
 from discord.ext import commands
 
+from . import ranking
+from .cache import TTLCache
+
 
 class YTDLError(Exception):
     pass
@@ -28,15 +34,68 @@ YTDL_OPTIONS = {
     'source_address': '0.0.0.0',
 }
 
+# Flat searches only list candidates (title, channel, duration, url) without
+# resolving formats, so ranking costs a single request per track.
+YTDL_FLAT_OPTIONS = {
+    **YTDL_OPTIONS,
+    'extract_flat': 'in_playlist',
+}
+
+# Watch/short links (and autocomplete picks) resolve straight to a video id.
+YOUTUBE_ID_RE = re.compile(r'^(?:https?://)?(?:(?:www\.|m\.|music\.)?youtube\.com/watch\?(?:.*&)?v=|youtu\.be/)([\w-]{11})(?:[&?#]|$)')
+
+SEARCH_CANDIDATES = 5
+SEARCH_CONCURRENCY = 4
+
 FFMPEG_OPTIONS = {
     'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
     'options': '-vn',
 }
 
+# Every tag we need from a Spotify page lives in <head>, so reading stops
+# as soon as these are known. The byte cap guards against pages that never
+# close their head (or aren't HTML at all).
+SPOTIFY_META_KEYS = ('og:title', 'og:description', 'og:image', 'music:musician_description', 'music:duration')
+META_CHUNK_SIZE = 4096
+META_MAX_BYTES = 512 * 1024
+
+spotify_cache = TTLCache(ttl=6 * 60 * 60, maxsize=1024)
+
+def ffmpeg_options(start: float = 0) -> dict:
+    """FFMPEG_OPTIONS, seeking `start` seconds into the input when resuming a track."""
+    if not start:
+        return FFMPEG_OPTIONS
+
+    return {**FFMPEG_OPTIONS, 'before_options': '{} -ss {:.2f}'.format(FFMPEG_OPTIONS['before_options'], start)}
+
+# googlevideo URLs carry their expiry either as `?expire=` or as `/expire/<ts>/`.
+EXPIRE_PATH_RE = re.compile(r'/expire/(\d+)(?:/|$)')
+
+def parse_stream_expiry(url: str):
+    """Returns the unix time a signed stream URL stops working, or None if it doesn't say."""
+    if not url:
+        return None
+
+    parts = urlsplit(url)
+    values = parse_qs(parts.query).get('expire')
+    if values and values[0].isdigit():
+        return int(values[0])
+
+    match = EXPIRE_PATH_RE.search(parts.path)
+    if match:
+        return int(match.group(1))
+
+    return None
+
 class MetaParser(HTMLParser):
     def __init__(self):
         super().__init__()
         self.metadata = {}
+        self.head_closed = False
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            self.head_closed = True
 
     def handle_starttag(self, tag, attrs):
         if tag == 'meta':
@@ -49,8 +108,9 @@ class MetaParser(HTMLParser):
 
 class YTDLSource(discord.PCMVolumeTransformer):
     ytdl = yt_dlp.YoutubeDL(YTDL_OPTIONS)
+    ytdl_flat = yt_dlp.YoutubeDL(YTDL_FLAT_OPTIONS)
 
-    def __init__(self, ctx: commands.Context, source: discord.FFmpegPCMAudio, *, data: dict, volume: float = 0.5):
+    def __init__(self, ctx: commands.Context, source: discord.FFmpegPCMAudio, *, data: dict, volume: float = 0.5, start: float = 0):
         super().__init__(source, volume)
 
         self.requester = ctx.author
@@ -71,10 +131,43 @@ class YTDLSource(discord.PCMVolumeTransformer):
         self.likes = data.get('like_count')
         self.dislikes = data.get('dislike_count')
         self.stream_url = data.get('url')
+        self.expires_at = parse_stream_expiry(self.stream_url)
+        self.start = start
 
     def __str__(self):
         return '**{0.title}** by **{0.uploader}**'.format(self)
 
+    def expires_within(self, seconds: float) -> bool:
+        return self.expires_at is not None and self.expires_at - time.time() <= seconds
+
+    def set_stream_url(self, url: str, *, reload: bool = True):
+        """Swaps in a freshly resolved stream URL.
+
+        With `reload` the ffmpeg process is restarted on the new URL right away;
+        pass False for a source that is playing, which picks the URL up on `rewind`.
+        """
+        self.data['url'] = url
+        self.stream_url = url
+        self.expires_at = parse_stream_expiry(url)
+
+        if reload:
+            self._reload()
+
+    def rewind(self):
+        """Restarts the source from the beginning, e.g. when a looped song plays again."""
+        self.start = 0
+        self._reload()
+
+    def _reload(self):
+        original = self.original
+        self.original = discord.FFmpegPCMAudio(self.stream_url, **ffmpeg_options(self.start))
+        original.cleanup()
+
+    async def refresh(self, *, loop: asyncio.BaseEventLoop = None, reload: bool = True):
+        """Re-resolves only the stream URL of this source's video."""
+        info = await self.extract_full(self.url or self.video_url(self.data['id']), loop=loop)
+        self.set_stream_url(info['url'], reload=reload)
+
     @classmethod
     async def create_source(cls, ctx: commands.Context, search: str, *, loop: asyncio.BaseEventLoop = None):
         loop = loop or asyncio.get_event_loop()
@@ -97,24 +190,57 @@ class YTDLSource(discord.PCMVolumeTransformer):
             if process_info is None:
                 raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
 
-        webpage_url = process_info['webpage_url']
+        info = await cls.extract_full(process_info['webpage_url'], loop=loop)
+        return cls(ctx, discord.FFmpegPCMAudio(info['url'], **FFMPEG_OPTIONS), data=info)
+
+    @classmethod
+    async def create_source_from_id(cls, ctx: commands.Context, video_id: str, *, loop: asyncio.BaseEventLoop = None):
+        """Creates a source for a known YouTube video id with a single extraction."""
+        return await cls.create_source_from_url(ctx, cls.video_url(video_id), loop=loop)
+
+    @classmethod
+    async def create_source_from_url(cls, ctx: commands.Context, webpage_url: str, *, loop: asyncio.BaseEventLoop = None, start: float = 0):
+        """Creates a source for a known page URL with a single extraction, optionally `start` seconds in."""
+        info = await cls.extract_full(webpage_url, loop=loop)
+        return cls(ctx, discord.FFmpegPCMAudio(info['url'], **ffmpeg_options(start)), data=info, start=start)
+
+    @staticmethod
+    def parse_video_id(search: str):
+        match = YOUTUBE_ID_RE.match(search.strip())
+        return match.group(1) if match else None
+
+    @staticmethod
+    def video_url(video_id: str) -> str:
+        return f"https://www.youtube.com/watch?v={video_id}"
+
+    @classmethod
+    async def extract_full(cls, webpage_url: str, *, loop: asyncio.BaseEventLoop = None) -> dict:
+        """Fully extracts a single video, resolving its stream URL.
+
+        Removed, private or otherwise unavailable videos raise YTDLError too.
+        """
+        loop = loop or asyncio.get_event_loop()
+
         partial = functools.partial(cls.ytdl.extract_info, webpage_url, download=False)
-        processed_info = await loop.run_in_executor(None, partial)
+        try:
+            processed_info = await loop.run_in_executor(None, partial)
+        except yt_dlp.utils.DownloadError as e:
+            raise YTDLError('Couldn\'t fetch `{}`: {}'.format(webpage_url, str(e)))
 
         if processed_info is None:
             raise YTDLError('Couldn\'t fetch `{}`'.format(webpage_url))
 
         if 'entries' not in processed_info:
-            info = processed_info
-        else:
-            info = None
-            while info is None:
-                try:
-                    info = processed_info['entries'].pop(0)
-                except IndexError:
-                    raise YTDLError('Couldn\'t retrieve any matches for `{}`'.format(webpage_url))
+            return processed_info
 
-        return cls(ctx, discord.FFmpegPCMAudio(info['url'], **FFMPEG_OPTIONS), data=info)
+        info = None
+        while info is None:
+            try:
+                info = processed_info['entries'].pop(0)
+            except IndexError:
+                raise YTDLError('Couldn\'t retrieve any matches for `{}`'.format(webpage_url))
+
+        return info
 
     @classmethod
     async def handle_spotify_url(cls, ctx: commands.Context, url: str):
@@ -128,125 +254,146 @@ class YTDLSource(discord.PCMVolumeTransformer):
         return await cls.search_best_match(ctx, search_query, track_info)
 
     @staticmethod
-    async def get_spotify_metadata(url: str) -> dict:
-        """Extracts metadata from Spotify URL using HTMLParser."""
+    async def fetch_page_metadata(url: str, required=()) -> dict:
+        """Streams a page into MetaParser and returns its meta tags.
+
+        Reading stops, and the connection is dropped, once `</head>` has been
+        seen, all `required` keys are present or META_MAX_BYTES were read.
+        """
+        parser = MetaParser()
         async with aiohttp.ClientSession() as session:
-            try:
-                async with session.get(url) as response:
-                    if response.status != 200:
-                        raise YTDLError(f'Failed to fetch Spotify page: {response.status}')
-                    
-                    html = await response.text()
-                    parser = MetaParser()
-                    parser.feed(html)
-                    
-                    metadata = {}
-                    meta_tags = parser.metadata
-                    
-                    if 'og:title' in meta_tags:
-                        metadata['title'] = meta_tags['og:title']
-                    
-                    if 'og:description' in meta_tags:
-                        metadata['description'] = meta_tags['og:description']
-                    
-                    if 'og:image' in meta_tags:
-                        metadata['image'] = meta_tags['og:image']
-                    
-                    if 'music:musician_description' in meta_tags:
-                        metadata['artist'] = meta_tags['music:musician_description']
-
-                    # If artist not found in musician tag, try to extract from title
-                    if 'artist' not in metadata and ' - ' in metadata.get('title', ''):
-                        metadata['artist'] = metadata['title'].split(' - ')[0].strip()
-                        metadata['title'] = metadata['title'].split(' - ')[1].strip()
-                    
-                    parser.close()
-                    return metadata
-                    
-            except Exception as e:
-                raise YTDLError(f'Error extracting Spotify metadata: {str(e)}')
+            async with session.get(url) as response:
+                if response.status != 200:
+                    raise YTDLError(f'Failed to fetch page: {response.status}')
+
+                decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+                received = 0
+                async for chunk in response.content.iter_chunked(META_CHUNK_SIZE):
+                    received += len(chunk)
+                    parser.feed(decoder.decode(chunk))
+
+                    if parser.head_closed or received >= META_MAX_BYTES:
+                        break
+                    if required and all(key in parser.metadata for key in required):
+                        break
+
+                # Don't let the context manager drain the rest of the body.
+                response.close()
+
+        parser.close()
+        return parser.metadata
+
+    @staticmethod
+    def spotify_cache_key(url: str) -> str:
+        """Strips query and fragment (e.g. `?si=...`) so share links hit the same entry."""
+        parts = urlsplit(url.strip())
+        return urlunsplit((parts.scheme, parts.netloc.lower(), parts.path.rstrip('/'), '', ''))
 
     @classmethod
-    async def search_best_match(cls, ctx: commands.Context, search_query: str, spotify_info: dict):
-        """Searches for the best matching video on YouTube and creates a source."""
-        loop = ctx.bot.loop or asyncio.get_event_loop()
-        
-        # First, search for videos
-        partial = functools.partial(cls.ytdl.extract_info, f"ytsearch5:{search_query}", download=False)
+    async def get_spotify_metadata(cls, url: str) -> dict:
+        """Extracts metadata from Spotify URL using HTMLParser."""
+        key = cls.spotify_cache_key(url)
+        cached = spotify_cache.get(key)
+        if cached is not None:
+            return dict(cached)
+
+        try:
+            meta_tags = await cls.fetch_page_metadata(url, required=SPOTIFY_META_KEYS)
+        except YTDLError:
+            raise
+        except Exception as e:
+            raise YTDLError(f'Error extracting Spotify metadata: {str(e)}')
+
+        metadata = {}
+
+        if 'og:title' in meta_tags:
+            metadata['title'] = meta_tags['og:title']
+
+        if 'og:description' in meta_tags:
+            metadata['description'] = meta_tags['og:description']
+
+        if 'og:image' in meta_tags:
+            metadata['image'] = meta_tags['og:image']
+
+        if 'music:musician_description' in meta_tags:
+            metadata['artist'] = meta_tags['music:musician_description']
+
+        if meta_tags.get('music:duration', '').isdigit():
+            metadata['duration'] = int(meta_tags['music:duration'])
+
+        # If artist not found in musician tag, try to extract from title
+        if 'artist' not in metadata and ' - ' in metadata.get('title', ''):
+            metadata['artist'] = metadata['title'].split(' - ')[0].strip()
+            metadata['title'] = metadata['title'].split(' - ')[1].strip()
+
+        if metadata:
+            spotify_cache.set(key, metadata)
+
+        return dict(metadata)
+
+    @classmethod
+    async def search_candidates(cls, search_query: str, *, loop: asyncio.BaseEventLoop = None) -> list:
+        """Lists YouTube search results without extracting any of them."""
+        loop = loop or asyncio.get_event_loop()
+
+        partial = functools.partial(cls.ytdl_flat.extract_info, f"ytsearch{SEARCH_CANDIDATES}:{search_query}", download=False)
         info = await loop.run_in_executor(None, partial)
-        
+
         if not info or 'entries' not in info:
             raise YTDLError(f'Could not find matches for `{search_query}`')
-        
-        # Score and find the best match
-        best_match = None
-        best_score = float('-inf')
-        
-        for entry in info['entries']:
-            if not entry:
-                continue
-                
-            score = cls.calculate_match_score(entry, spotify_info)
-            if score > best_score:
-                best_score = score
-                best_match = entry
-        
-        if not best_match:
+
+        return [entry for entry in info['entries'] if entry]
+
+    @classmethod
+    async def search_best_match(cls, ctx: commands.Context, search_query: str, spotify_info: dict):
+        """Searches for the best matching video on YouTube and creates a source."""
+        loop = ctx.bot.loop or asyncio.get_event_loop()
+
+        entries = await cls.search_candidates(search_query, loop=loop)
+        ranked = ranking.rank_candidates(ranking.TrackQuery.from_spotify(spotify_info), entries)
+
+        if not ranked:
             raise YTDLError(f'No suitable matches found for `{search_query}`')
 
-        # Get the full info for the best match
-        webpage_url = best_match['webpage_url']
-        partial = functools.partial(cls.ytdl.extract_info, webpage_url, download=False)
-        processed_info = await loop.run_in_executor(None, partial)
+        # Only one candidate gets a full extraction, unless it turns out to be
+        # unavailable; then the runner-up is tried without searching again.
+        for _, entry in ranked:
+            try:
+                info = await cls.extract_full(cls.entry_url(entry), loop=loop)
+            except YTDLError as e:
+                print(f"Error extracting {cls.entry_url(entry)}: {e}")
+                continue
 
-        if processed_info is None:
-            raise YTDLError(f'Couldn\'t fetch `{webpage_url}`')
+            return cls(ctx, discord.FFmpegPCMAudio(info['url'], **FFMPEG_OPTIONS), data=info)
 
-        if 'entries' not in processed_info:
-            info = processed_info
-        else:
-            info = None
-            while info is None:
+        raise YTDLError(f'None of the matches for `{search_query}` could be played')
+
+    @classmethod
+    async def search_best_matches(cls, tracks: list, *, loop: asyncio.BaseEventLoop = None) -> list:
+        """Finds the best YouTube entry for many Spotify tracks at once, e.g. for bulk imports.
+
+        Returns the chosen flat entries (or None) in the same order as `tracks`;
+        nothing is fully extracted, so callers resolve streams only when needed.
+        """
+        loop = loop or asyncio.get_event_loop()
+        semaphore = asyncio.Semaphore(SEARCH_CONCURRENCY)
+
+        async def search(track_info):
+            search_query = f"{track_info.get('artist', '')} - {track_info.get('title', '')}"
+            async with semaphore:
                 try:
-                    info = processed_info['entries'].pop(0)
-                except IndexError:
-                    raise YTDLError(f'Couldn\'t retrieve any matches for `{webpage_url}`')
+                    return await cls.search_candidates(search_query, loop=loop)
+                except (YTDLError, yt_dlp.utils.DownloadError) as e:
+                    print(f"Error searching for {search_query}: {e}")
+                    return []
 
-        return cls(ctx, discord.FFmpegPCMAudio(info['url'], **FFMPEG_OPTIONS), data=info)
+        results = await asyncio.gather(*(search(track_info) for track_info in tracks))
+        return ranking.best_matches(zip(tracks, results))
 
-    @staticmethod
-    def calculate_match_score(yt_entry: dict, spotify_info: dict) -> float:
-        """Calculates a matching score between YouTube entry and Spotify metadata."""
-        score = 0.0
-        
-        def clean_text(text):
-            return re.sub(r'[^\w\s]', '', text.lower())
-        
-        yt_title = clean_text(yt_entry.get('title', ''))
-        spotify_title = clean_text(spotify_info.get('title', ''))
-        spotify_artist = clean_text(spotify_info.get('artist', ''))
-        
-        # Title match
-        if spotify_title in yt_title:
-            score += 10
-        
-        # Artist match
-        if spotify_artist in yt_title:
-            score += 5
-        
-        # Prefer official content
-        if yt_entry.get('channel', '').lower().endswith('- topic'):
-            score += 3
-        if 'official' in yt_title:
-            score += 2
-        
-        # Penalize likely wrong matches
-        if 'cover' in yt_title.lower():
-            score -= 5
-        if 'remix' in yt_title.lower() and 'remix' not in spotify_title:
-            score -= 3
-        
-        return score
+    @classmethod
+    def entry_url(cls, entry: dict) -> str:
+        """Flat entries carry the watch URL in `url`; full ones in `webpage_url`."""
+        return entry.get('webpage_url') or entry.get('url') or cls.video_url(entry['id'])
 
     @staticmethod
     def parse_duration(duration: int):